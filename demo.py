@@ -1,29 +1,70 @@
 import os
+import gzip
 import time
-import json
-from typing import TypedDict, Dict, Any
+import asyncio
+import hashlib
+import random
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TypedDict, Dict, Any, AsyncIterator, Callable, List, Optional, Tuple
 
 import httpx
-from flask import Flask, request, jsonify
+import orjson
+from aiolimiter import AsyncLimiter
+from quart import Quart, Response, request
 from dotenv import load_dotenv
+from pydantic import BaseModel, field_validator
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from langgraph.graph import StateGraph, END
+from langgraph.types import CachePolicy, StreamWriter
+from langgraph.cache.sqlite import SqliteCache
+
+try:
+    # 可选依赖：安装 sentence-transformers 后启用语义缓存，否则只做精确匹配缓存
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
 
 # ================== Basic Setup ==================
 # 从 .env 读取环境变量
 load_dotenv(override=True)
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 # 模型与 Replicate API 基础配置
 MODEL_REF = "meta/meta-llama-3-8b-instruct"
 REPLICATE_API_BASE = "https://api.replicate.com/v1"
 
+# 同一进程内同时发往 Replicate 的请求上限（只限制并发数，不限制速率）
+REPLICATE_CONCURRENCY = int(os.getenv("REPLICATE_CONCURRENCY", "8"))
+# 同一进程内每分钟创建 prediction 的上限（令牌桶，在本地排队，而不是撞上 429 再重试）；
+# Replicate 文档中创建 prediction 的限额为 600 次/分钟，多 worker 部署时按 worker 数均分
+REPLICATE_RPM = int(os.getenv("REPLICATE_RPM", "600"))
+
+# 启动时预热：建立 TLS 连接、缓存 version id，并让 Replicate 保持模型容器热启动（会产生少量费用）
+WARMUP = os.getenv("WARMUP", "1") == "1"
+
+# 可选：直接固定模型 version id（生产环境推荐），跳过 latest_version 查询
+MODEL_VERSION = (os.getenv("REPLICATE_MODEL_VERSION") or "").strip()
+# latest_version id 的缓存时间（秒）
+MODEL_VERSION_TTL = 3600
+
 # 从环境变量读取 Token
 TOKEN = (os.getenv("REPLICATE_API_TOKEN") or "").strip()
 
 # 证书路径（服务器环境常见；本地一般不需要改）
 CA_BUNDLE = os.getenv("SSL_CERT_FILE", "/etc/ssl/certs/ca-certificates.crt")
 
+# 语义缓存：embedding 模型、相似度阈值、每个 system prompt 最多缓存的条目数
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "all-MiniLM-L6-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+
+# LangGraph 节点缓存：SQLite 文件路径与过期时间（秒），跨进程/重启都能复用
+NODE_CACHE_DB = os.getenv("NODE_CACHE_DB", "chat_cache.db")
+NODE_CACHE_TTL = int(os.getenv("NODE_CACHE_TTL", "3600"))
+
 
 # ================== Prompts ==================
 SYSTEM_PROMPT = """# Role: OCI Intelligent Documentation Assistant (OCI IDA)
@@ -53,36 +94,32 @@ SYSTEM_PROMPT = """# Role: OCI Intelligent Documentation Assistant (OCI IDA)
 5. 所有示例都用占位符（<tenancy_ocid>, <your_compartment_id>），不要输出任何真实密钥/Token。
 """
 
-# Router：判断是否需要调用“命令生成工具”
-ROUTER_PROMPT = """# Role: Router
+# Plan：Router + Command Tool 合并为一次调用
+# 判断是否需要生成 OCI CLI command；需要时直接给出命令（字段不够就列 missing_fields）
+PLAN_PROMPT = """# Role: Router & OCI CLI Command Generator (Tool)
 
-任务：判断用户问题是否需要生成 OCI CLI command（use_command_tool）。
+任务：
+1. 判断用户问题是否需要生成 OCI CLI command（use_command_tool）。
+2. 如果需要，把用户意图转换为一条 OCI CLI command。
 
 只输出**单行**JSON（不要 Markdown / 不要解释）：
-{"use_command_tool": true/false, "missing_fields": [], "reason": ""}
+{"use_command_tool": true/false, "generated_command": "", "missing_fields": [], "notes": ""}
 
 判定规则：
 - 需要命令（true）：用户明确要 CLI/command；或问题是资源操作（list/create/delete/update/describe/get），例如 bucket/instance/vcn/volume 等。
-- 不需要命令（false）：纯概念解释、对比、原理、术语释义（what is / introduce / difference）。
-- missing_fields：只填生成命令所需的最小字段，例如 compartment_id、region、availability_domain、namespace、bucket_name、instance_id。
-"""
+- 不需要命令（false）：纯概念解释、对比、原理、术语释义（what is / introduce / difference）；此时 generated_command 置空、missing_fields 为 []。
 
-# Command Tool：把意图转为一条 OCI CLI 命令（如果字段不够就列 missing_fields）
-COMMAND_PROMPT = """# Role: OCI CLI Command Generator (Tool)
-
-任务：把用户意图转换为 OCI CLI command。
-
-只输出**单行**JSON（不要 Markdown / 不要解释）：
-{"generated_command": "", "missing_fields": [], "notes": ""}
-
-规则：
+命令规则（仅 use_command_tool 为 true 时）：
 - generated_command 必须以 'oci ' 开头；只输出一个最相关命令。
-- 用户未提供关键字段：用 missing_fields 列出最小必要字段，并将 generated_command 置空。
+- 用户未提供关键字段：用 missing_fields 列出最小必要字段（例如 compartment_id、region、availability_domain、namespace、bucket_name、instance_id），并将 generated_command 置空。
 - 可以使用占位符：
   <your_compartment_id>, <your_region>, <your_availability_domain>, <your_namespace>, <your_bucket_name>, <your_instance_id>
-- notes 用一句话提示（例如“需要先提供 compartment_id 才能列出 bucket”）。
+- notes 用一句简短的话提示（不超过 30 个字，例如“需要先提供 compartment_id 才能列出 bucket”）。
 """
 
+# 生成停止符：在 LLaMA 3 的结束 token 处停止
+STOP_SEQUENCES = "<|end_of_text|>,<|eot_id|>"
+
 # LLaMA 3 Instruct 模型的 chat prompt 模板
 LLAMA3_TEMPLATE = (
     "<|begin_of_text|>"
@@ -90,73 +127,153 @@ LLAMA3_TEMPLATE = (
     "<|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|>"
     "<|start_header_id|>assistant<|end_header_id|>\n\n"
 )
+_TEMPLATE_HEAD, _TEMPLATE_TAIL = LLAMA3_TEMPLATE.split("{prompt}")
+
+@lru_cache(maxsize=16)
+def _prompt_prefix(system_prompt: str) -> str:
+    """system prompt 部分只有几种，格式化结果缓存起来。"""
+    return _TEMPLATE_HEAD.replace("{system_prompt}", system_prompt)
+
+def build_prompt(system_prompt: str, prompt: str) -> str:
+    """在本地套好 LLaMA 3 模板，Replicate 端不再做模板渲染。"""
+    return _prompt_prefix(system_prompt) + prompt + "\n" + _TEMPLATE_TAIL
 
 
 # ================== Replicate Client ==================
 # 建议开启 trust_env=True，这样在某些环境下 httpx 能自动读代理/证书配置
-HTTPX_CLIENT = httpx.Client(verify=CA_BUNDLE, timeout=60, trust_env=True)
+# AsyncClient：等待 Replicate 网络/轮询时释放事件循环，多个对话可以在同一进程内交错执行
+# keepalive_expiry 默认只有 5s，对话间隔一长连接就被关掉、重新 TLS 握手；这里放宽到 75s（同 nginx 默认值）
+# http2=True：同一对话里的多个 prediction 复用一条 TCP/TLS 连接（需要 httpx[http2]）
+# 连接池绑定事件循环且不能跨 fork 共享，所以每个 worker 进程各自懒创建（见 get_client / before_serving）
+_HTTPX_CLIENT: Optional[httpx.AsyncClient] = None
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        verify=CA_BUNDLE,
+        timeout=httpx.Timeout(connect=10, read=60, write=10, pool=5),
+        trust_env=True,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=32, keepalive_expiry=75),
+    )
+
+def get_client() -> httpx.AsyncClient:
+    """返回当前进程的 httpx.AsyncClient（首次调用时创建）。"""
+    global _HTTPX_CLIENT
+    if _HTTPX_CLIENT is None or _HTTPX_CLIENT.is_closed:
+        _HTTPX_CLIENT = _new_client()
+    return _HTTPX_CLIENT
 
 def _headers() -> Dict[str, str]:
     return {"Authorization": f"Token {TOKEN}", "Content-Type": "application/json"}
 
-def run_replicate_model(system_prompt: str, prompt: str, max_tokens=200, temperature=0.3) -> str:
-    """
-    调用 Replicate 的 LLaMA 3 Instruct 模型：
-    1) 拉取 latest_version id
-    2) 创建 prediction（遇到 429 限流自动等待重试）
-    3) 轮询 prediction 状态直到 succeeded
-    """
-    if not TOKEN:
-        # 明确报错：避免“空 token”导致返回 HTML/异常结构后难定位
-        raise RuntimeError("REPLICATE_API_TOKEN is empty. Please set it in .env or environment variables.")
+_REPLICATE_SEM = asyncio.Semaphore(REPLICATE_CONCURRENCY)
+_REPLICATE_LIMITER = AsyncLimiter(REPLICATE_RPM, 60)
 
-    owner, name = MODEL_REF.split("/", 1)
+# latest_version id 几乎不变，缓存起来避免每次调用都多一次 GET
+_VERSION_CACHE: Dict[str, Any] = {"id": None, "expires": 0.0}
+_VERSION_LOCK = asyncio.Lock()
 
-    # 1) get latest version id
-    r = HTTPX_CLIENT.get(
-        f"{REPLICATE_API_BASE}/models/{owner}/{name}",
-        headers=_headers()
-    )
-    r.raise_for_status()
-    vid = r.json()["latest_version"]["id"]
+async def _model_version() -> str:
+    """返回模型 version id：优先用 REPLICATE_MODEL_VERSION，其次用缓存，过期后才重新拉取。"""
+    if MODEL_VERSION:
+        return MODEL_VERSION
+    if time.monotonic() < _VERSION_CACHE["expires"]:
+        return _VERSION_CACHE["id"]
 
-    # 2) create prediction（对 429 做等待重试）
-    while True:
-        r = HTTPX_CLIENT.post(
-            f"{REPLICATE_API_BASE}/predictions",
-            headers=_headers(),
-            json={
-                "version": vid,
-                "input": {
-                    "system_prompt": system_prompt,
-                    "prompt": prompt + "\n",
-                    "prompt_template": LLAMA3_TEMPLATE,
-                    "max_new_tokens": max_tokens,
-                    "temperature": temperature,
-                    "stop_sequences": "<|end_of_text|>,<|eot_id|>",
-                },
-            },
+    # 加锁：并发请求同时过期时只刷新一次
+    async with _VERSION_LOCK:
+        if time.monotonic() < _VERSION_CACHE["expires"]:
+            return _VERSION_CACHE["id"]
+
+        owner, name = MODEL_REF.split("/", 1)
+        r = await get_client().get(
+            f"{REPLICATE_API_BASE}/models/{owner}/{name}",
+            headers=_headers()
         )
+        r.raise_for_status()
+        vid = r.json()["latest_version"]["id"]
+        _VERSION_CACHE.update(id=vid, expires=time.monotonic() + MODEL_VERSION_TTL)
+        return vid
+
+class ReplicateRetryableError(Exception):
+    """Replicate 返回 429 / 5xx：可以重试的错误。"""
 
-        if r.status_code == 429:
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"Replicate HTTP {response.status_code}: {response.text[:200]}")
+        self.retry_after = 0.0
+        if response.status_code == 429:
             # Replicate 返回的 retry_after 单位通常是秒
             try:
-                retry_after = int(r.json().get("retry_after", 5))
+                self.retry_after = float(response.json().get("retry_after", 5)) + 1
             except Exception:
-                retry_after = 5
-            time.sleep(retry_after + 1)
-            continue
+                self.retry_after = 5
 
-        r.raise_for_status()
-        pid = r.json()["id"]
-        break
+_backoff = wait_exponential_jitter(initial=0.2, max=5.0)
+
+def _wait_replicate(retry_state) -> float:
+    """指数退避 + jitter；429 时至少等到服务端给出的 retry_after。"""
+    exc = retry_state.outcome.exception()
+    return max(_backoff(retry_state), getattr(exc, "retry_after", 0.0))
+
+@retry(
+    retry=retry_if_exception_type(ReplicateRetryableError),
+    wait=_wait_replicate,
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _post_prediction(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    POST /predictions；先经过令牌桶限速（REPLICATE_RPM），再占用并发槽位（REPLICATE_CONCURRENCY）。
+    429 / 5xx 由 tenacity 按上面的策略重试，最多 6 次；每次重试都重新计入限速。
+    """
+    async with _REPLICATE_LIMITER, _REPLICATE_SEM:
+        r = await get_client().post(f"{REPLICATE_API_BASE}/predictions", headers=_headers(), json=payload)
+    if r.status_code == 429 or r.status_code >= 500:
+        raise ReplicateRetryableError(r)
+    r.raise_for_status()
+    return r.json()
+
+async def _create_prediction(
+    system_prompt: str, prompt: str, max_tokens: int, temperature: float
+) -> Dict[str, Any]:
+    """
+    1) 取 version id（带缓存）
+    2) 创建 prediction（"stream": true，429 / 5xx 自动退避重试）
+    返回 create 接口的 JSON（包含 id 与 urls.stream）。
+    """
+    if not TOKEN:
+        # 明确报错：避免“空 token”导致返回 HTML/异常结构后难定位
+        raise RuntimeError("REPLICATE_API_TOKEN is empty. Please set it in .env or environment variables.")
+
+    # 1) get version id
+    vid = await _model_version()
+
+    # 2) create prediction
+    return await _post_prediction({
+        "version": vid,
+        "stream": True,
+        "input": {
+            # 已在本地套好模板；prompt_template 设为原样透传，避免服务端再套一次默认模板
+            "prompt": build_prompt(system_prompt, prompt),
+            "prompt_template": "{prompt}",
+            "max_new_tokens": max_tokens,
+            "temperature": temperature,
+            "stop_sequences": STOP_SEQUENCES,
+        },
+    })
 
-    # 3) poll prediction
+async def _poll_prediction(pid: str) -> str:
+    """
+    轮询 prediction 状态直到 succeeded（模型不支持 stream 时的兜底）。
+    间隔从 100ms 开始指数退避（带 jitter），上限 2s：短生成能尽快拿到结果，长生成也不会频繁打 API。
+    """
+    delay = 0.1
     while True:
-        j = HTTPX_CLIENT.get(
-            f"{REPLICATE_API_BASE}/predictions/{pid}",
-            headers=_headers()
-        ).json()
+        async with _REPLICATE_SEM:
+            j = (await get_client().get(
+                f"{REPLICATE_API_BASE}/predictions/{pid}",
+                headers=_headers()
+            )).json()
 
         if j["status"] == "succeeded":
             out = j.get("output", "")
@@ -165,7 +282,184 @@ def run_replicate_model(system_prompt: str, prompt: str, max_tokens=200, tempera
         if j["status"] in ("failed", "canceled"):
             raise RuntimeError(f"Replicate prediction {j['status']}: {j}")
 
-        time.sleep(1)
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5 + random.uniform(0, 0.05), 2.0)
+
+async def stream_replicate_model(
+    system_prompt: str, prompt: str, max_tokens=200, temperature=0.3
+) -> AsyncIterator[str]:
+    """
+    调用 Replicate 的 LLaMA 3 Instruct 模型，逐段 yield 生成的文本：
+    - 优先读取 create 返回的 urls.stream（Server-Sent Events），token 一生成就拿到；
+    - 没有 stream URL 时回退为轮询，最后一次性 yield 完整输出。
+    """
+    pred = await _create_prediction(system_prompt, prompt, max_tokens, temperature)
+    stream_url = (pred.get("urls") or {}).get("stream")
+    if not stream_url:
+        yield await _poll_prediction(pred["id"])
+        return
+
+    # SSE：event/data 行累积，空行表示一个事件结束；多行 data 用 \n 拼接
+    event, data = "output", []
+    done = False
+    async with get_client().stream(
+        "GET",
+        stream_url,
+        headers={"Accept": "text/event-stream", "Cache-Control": "no-store"},
+    ) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                # 只去掉冒号后的一个空格，token 自身的前导空格要保留
+                value = line[5:]
+                data.append(value[1:] if value.startswith(" ") else value)
+            elif line == "":
+                text = "\n".join(data)
+                if event == "output" and data:
+                    yield text
+                elif event == "error":
+                    raise RuntimeError(f"Replicate prediction failed: {text}")
+                elif event == "done":
+                    # done 的 data 为 {} 表示成功；{"reason": "canceled"/"error"} 表示没有正常完成
+                    info = parse_json_loose(text) if text else None
+                    reason = info.get("reason") if isinstance(info, dict) else None
+                    if reason:
+                        raise RuntimeError(f"Replicate prediction {reason}: {text}")
+                    done = True
+                    break
+                event, data = "output", []
+
+    # 连接在 done 之前断开：输出不完整，报错而不是当作成功返回（否则截断的结果会被写进缓存）
+    if not done:
+        raise RuntimeError("Replicate stream ended before the done event")
+
+# ================== Semantic Cache ==================
+class SemanticCache:
+    """
+    LLM 输出缓存：先按 (system_prompt, prompt) 哈希精确匹配，
+    未命中时再用 embedding 余弦相似度（>= threshold）查找近似问题。
+    语义匹配只对 semantic_prompts 中的 system prompt 生效，每个 system prompt 单独一份索引；
+    并且 prompt 中的 OCID / 引号内的名称必须完全一致才算命中，避免返回别的资源 ID。
+    """
+
+    # OCID，以及引号 / 反引号 / 尖括号中的名称（bucket 名、region 等）
+    _IDENT_RE = re.compile(r"ocid1\.[\w.-]+|\"[^\"]+\"|'[^']+'|`[^`]+`|<[^<>]+>", re.I)
+
+    def __init__(self, model_name: str, threshold: float, max_size: int, semantic_prompts=()):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.max_size = max_size
+        self._semantic = {self._hash(p) for p in semantic_prompts}
+        self._model = None
+        # 精确匹配：hash(system_prompt, prompt) -> response（LRU）
+        self._exact: "OrderedDict[str, str]" = OrderedDict()
+        # 语义匹配：hash(system_prompt) -> [(normalized embedding, identifiers, response)]
+        self._vectors: Dict[str, List[Tuple[Any, frozenset, str]]] = {}
+
+    @staticmethod
+    def _hash(*parts: str) -> str:
+        return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _identifiers(cls, prompt: str) -> frozenset:
+        return frozenset(m.lower() for m in cls._IDENT_RE.findall(prompt))
+
+    def load(self) -> None:
+        """
+        加载 embedding 模型（耗时数秒，应在服务启动时调用，而不是在第一个请求里）。
+        加载失败（例如离线无法下载模型）时记录警告并关闭语义匹配，只保留精确匹配，不影响服务启动。
+        """
+        if SentenceTransformer is not None and self._semantic and self._model is None:
+            try:
+                self._model = SentenceTransformer(self.model_name)
+            except Exception:
+                app.logger.warning(
+                    "Failed to load embedding model %s; semantic cache disabled", self.model_name, exc_info=True
+                )
+                self._semantic.clear()
+
+    def _encode(self, text: str):
+        """返回 prompt 的 embedding；模型不可用时返回 None。"""
+        self.load()
+        if self._model is None:
+            return None
+        return self._model.encode(text, normalize_embeddings=True)
+
+    async def get(self, system_prompt: str, prompt: str) -> Tuple[Optional[str], Any]:
+        """
+        返回 (命中的 response 或 None, prompt 的 embedding)。
+        embedding 交给 put 复用，未命中时不用再算一次；不走语义匹配时为 None。
+        """
+        key = self._hash(system_prompt, prompt)
+        if key in self._exact:
+            self._exact.move_to_end(key)
+            return self._exact[key], None
+
+        if SentenceTransformer is None or self._hash(system_prompt) not in self._semantic:
+            return None, None
+
+        # encode 是 CPU 密集操作，放到线程里避免阻塞事件循环
+        vec = await asyncio.to_thread(self._encode, prompt)
+        if vec is None:
+            return None, None
+        idents = self._identifiers(prompt)
+        candidates = [
+            (float(v @ vec), r)
+            for v, i, r in self._vectors.get(self._hash(system_prompt), [])
+            if i == idents
+        ]
+        if candidates:
+            score, response = max(candidates, key=lambda x: x[0])
+            if score >= self.threshold:
+                return response, vec
+        return None, vec
+
+    def put(self, system_prompt: str, prompt: str, response: str, vec: Any = None) -> None:
+        """写入缓存；vec 为 get 返回的 embedding（为 None 时只写精确匹配）。"""
+        self._exact[self._hash(system_prompt, prompt)] = response
+        if len(self._exact) > self.max_size:
+            self._exact.popitem(last=False)
+
+        if vec is None:
+            return
+        entries = self._vectors.setdefault(self._hash(system_prompt), [])
+        entries.append((vec, self._identifiers(prompt), response))
+        if len(entries) > self.max_size:
+            entries.pop(0)
+
+
+# 语义匹配只用于最终回答：Plan 输出里的 generated_command 带具体资源 ID，只做精确匹配
+LLM_CACHE = SemanticCache(
+    SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE, semantic_prompts=(SYSTEM_PROMPT,)
+)
+
+async def run_replicate_model(
+    system_prompt: str,
+    prompt: str,
+    max_tokens=200,
+    temperature=0.3,
+    on_chunk: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    调用模型并返回完整输出；命中缓存时不调用 Replicate。
+    on_chunk：每收到一段文本就回调一次（命中缓存时整段回调一次），用于把回答流式推给浏览器。
+    """
+    cached, vec = await LLM_CACHE.get(system_prompt, prompt)
+    if cached is not None:
+        if on_chunk:
+            on_chunk(cached)
+        return cached
+
+    parts = []
+    async for chunk in stream_replicate_model(system_prompt, prompt, max_tokens, temperature):
+        if on_chunk:
+            on_chunk(chunk)
+        parts.append(chunk)
+    out = "".join(parts)
+    LLM_CACHE.put(system_prompt, prompt, out, vec)
+    return out
 
 
 # ================== LangGraph ==================
@@ -179,179 +473,316 @@ class State(TypedDict, total=False):
     # 最终回答
     reply: str
 
-def router(state: State) -> State:
-    """Router：判断是否需要生成 CLI 命令。"""
-    raw = run_replicate_model(ROUTER_PROMPT, state["user_input"], 120, 0.2)
-    try:
-        state["route"] = json.loads(raw)
-    except Exception:
-        # Router 输出不符合 JSON 时，保守回退：不调用工具
-        state["route"] = {
-            "use_command_tool": False,
-            "missing_fields": [],
-            "reason": "Router output not valid JSON"
-        }
-    return state
+# 快速路由：高置信度的输入直接判定，不需要先问 LLM
+# 中文没有单词边界，\b 对“什么是/原理”等词不可靠，所以单独写
+CONCEPT_RE = re.compile(
+    r"\b(what is|what's|what are|introduce|difference|compare|explain)\b|什么是|是什么|介绍|原理|概念|区别|对比",
+    re.I,
+)
+CMD_RE = re.compile(
+    r"^\s*(?-i:oci\s+[a-z][\w-]*\s+[a-z])|\b(cli|command)\b|命令"
+    r"|\b(list|create|delete|update|describe|get)\s+(an?\s+|the\s+|all\s+|my\s+)?(oci\s+)?"
+    r"(buckets?|instances?|vcns?|volumes?|compartments?)\b",
+    re.I,
+)
+# 提到具体资源（名词或 OCID）的“概念类”问题可能其实是资源查询（例如 “what are my buckets”），不能走快速路径
+RESOURCE_RE = re.compile(
+    r"\b(buckets?|instances?|vcns?|subnets?|volumes?|compartments?|ocids?)\b|ocid1\.|存储桶|实例|子网|卷|区间",
+    re.I,
+)
 
-def command(state: State) -> State:
-    """Command Tool：把意图转换为 OCI CLI command（JSON）。"""
-    raw = run_replicate_model(COMMAND_PROMPT, state["user_input"], 200, 0.2)
+def heuristic_route(q: str) -> Optional[bool]:
+    """
+    关键词快速判定是否需要命令：
+    - 只命中概念类、且没有提到具体资源 -> False；只命中命令类 -> True；
+    - 其余情况（例如 “what is the command to list buckets” / “what are my buckets”）-> None，交给 LLM 判断。
+    """
+    concept = bool(CONCEPT_RE.search(q))
+    cmd = bool(CMD_RE.search(q))
+    if cmd and not concept:
+        return True
+    if concept and not cmd and not RESOURCE_RE.search(q):
+        return False
+    return None
+
+class PlanOut(BaseModel):
+    """
+    Plan 输出的 JSON 结构。
+    字段做宽松转换（null -> 默认值、字符串 -> 列表等），单个字段不规范不会让整个结果作废。
+    """
+    use_command_tool: bool = False
+    generated_command: str = ""
+    missing_fields: List[str] = []
+    notes: str = ""
+
+    @field_validator("use_command_tool", mode="before")
+    @classmethod
+    def _to_bool(cls, v: Any) -> bool:
+        if isinstance(v, str):
+            return v.strip().lower() in ("true", "yes", "1")
+        return bool(v)
+
+    @field_validator("generated_command", "notes", mode="before")
+    @classmethod
+    def _to_str(cls, v: Any) -> str:
+        if v is None:
+            return ""
+        return v if isinstance(v, str) else str(v)
+
+    @field_validator("missing_fields", mode="before")
+    @classmethod
+    def _to_list(cls, v: Any) -> List[str]:
+        if not v:
+            return []
+        if isinstance(v, str):
+            return [f.strip() for f in v.split(",") if f.strip()]
+        if isinstance(v, (list, tuple)):
+            return [str(f) for f in v if f]
+        return [str(v)]
+
+# 第一个 { 到最后一个 } 之间的内容（模型偶尔会加 ```json 代码块或解释文字）
+_JSON_RE = re.compile(r"\{.*\}", re.S)
+
+def parse_json_loose(raw: str) -> Optional[Any]:
+    """先按严格 JSON 解析，失败后再从文本中截取 {...} 解析；都失败返回 None。"""
     try:
-        state["command"] = json.loads(raw)
-    except Exception:
-        # Tool 输出不符合 JSON 时，给空结果，避免后续 500
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        pass
+    m = _JSON_RE.search(raw)
+    if not m:
+        return None
+    try:
+        return orjson.loads(m.group(0))
+    except orjson.JSONDecodeError:
+        return None
+
+def parse_plan(raw: str) -> Dict[str, Any]:
+    """解析并校验 Plan 输出。"""
+    data = parse_json_loose(raw)
+    if isinstance(data, dict):
+        return PlanOut.model_validate(data).model_dump()
+    # 严格解析与宽松解析都拿不到 JSON 对象时，保守回退：不调用工具
+    return {
+        "use_command_tool": False,
+        "missing_fields": [],
+        "reason": "Plan output not valid JSON"
+    }
+
+async def plan(state: State) -> State:
+    """
+    Plan：一次 Replicate 调用同时完成 Router 与 Command Tool。
+    Router 判定不需要命令时，不写入 command（answer 不会附加 [CommandTool]）。
+    明显的概念类问题由 heuristic_route 直接判定，完全跳过这次调用。
+    """
+    q = state["user_input"]
+    use_tool = heuristic_route(q)
+    if use_tool is False:
+        state["route"] = {"use_command_tool": False, "missing_fields": [], "reason": "heuristic: concept question"}
+        return state
+
+    # Plan 的 JSON 只含返回给前端的字段，输出较短，上限 160 token（生成耗时与 token 数线性相关）；
+    # 不在换行处停止：模型偶尔先输出 ```json 代码块，交给 parse_json_loose 处理
+    out = parse_plan(await run_replicate_model(PLAN_PROMPT, q, 160, 0.2))
+    if use_tool is None:
+        use_tool = bool(out.get("use_command_tool"))
+    state["route"] = {
+        "use_command_tool": use_tool,
+        "missing_fields": out.get("missing_fields", []),
+        "reason": out.get("reason", ""),
+    }
+    if state["route"]["use_command_tool"]:
         state["command"] = {
-            "generated_command": "",
-            "missing_fields": [],
-            "notes": "Command output not valid JSON"
+            "generated_command": out.get("generated_command", ""),
+            "missing_fields": out.get("missing_fields", []),
+            "notes": out.get("notes", ""),
         }
     return state
 
-def answer(state: State) -> State:
+async def answer(state: State, writer: StreamWriter) -> State:
     """
     Answer：最终回答节点。
-    如果 command 节点跑过，会把 [CommandTool] JSON 附加到 user prompt，便于模型引用工具结果。
+    如果 Router 判定需要命令，会把 [CommandTool] JSON 附加到 user prompt，便于模型引用工具结果。
+    生成的文本通过 writer 实时写入 LangGraph 的 custom 流（ainvoke 时 writer 为空操作）。
     """
     tool_info = ""
     if "command" in state:
-        tool_info = f"\n[CommandTool]\n{json.dumps(state['command'], ensure_ascii=False)}\n"
+        tool_info = f"\n[CommandTool]\n{orjson.dumps(state['command']).decode()}\n"
 
-    state["reply"] = run_replicate_model(
+    state["reply"] = await run_replicate_model(
         SYSTEM_PROMPT,
         state["user_input"] + tool_info,
         300,
         0.3,
+        on_chunk=writer,
     )
     return state
 
-def route_decision(state: State) -> str:
-    """根据 Router 的判断决定走 command 还是直接 answer。"""
-    return "command" if state["route"].get("use_command_tool") else "answer"
+def _cache_fingerprint(system_prompt: str) -> str:
+    """system prompt + 模板 + 模型的短哈希：改了 prompt 或换了模型后，SQLite 里的旧结果不再命中。"""
+    parts = (system_prompt, LLAMA3_TEMPLATE, MODEL_REF, MODEL_VERSION)
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()[:16]
+
+_PLAN_CACHE_FP = _cache_fingerprint(PLAN_PROMPT)
+_ANSWER_CACHE_FP = _cache_fingerprint(SYSTEM_PROMPT)
+
+def _plan_cache_key(state: State) -> str:
+    """plan 只依赖 user_input（以及 PLAN_PROMPT / 模型）。"""
+    return f"{_PLAN_CACHE_FP}:{state['user_input']}"
 
+def _answer_cache_key(state: State) -> bytes:
+    """answer 依赖 user_input 与 command 结果（以及 SYSTEM_PROMPT / 模型）。"""
+    return orjson.dumps([_ANSWER_CACHE_FP, state["user_input"], state.get("command")], option=orjson.OPT_SORT_KEYS)
 
-# 构建 LangGraph 流程
+
+# 构建 LangGraph 流程：plan（Router + Command 一次调用）→ answer
+# 节点级缓存（精确匹配）：相同输入直接返回缓存的节点输出；近似的回答由 LLM_CACHE 的语义匹配兜底
 graph = StateGraph(State)
-graph.add_node("router", router)
-graph.add_node("command", command)
-graph.add_node("answer", answer)
+graph.add_node("plan", plan, cache_policy=CachePolicy(key_func=_plan_cache_key, ttl=NODE_CACHE_TTL))
+graph.add_node("answer", answer, cache_policy=CachePolicy(key_func=_answer_cache_key, ttl=NODE_CACHE_TTL))
 
-graph.set_entry_point("router")
-graph.add_conditional_edges("router", route_decision, {"command": "command", "answer": "answer"})
-graph.add_edge("command", "answer")
+graph.set_entry_point("plan")
+graph.add_edge("plan", "answer")
 graph.add_edge("answer", END)
 
-CHAT_GRAPH = graph.compile()
+# 编译后的图持有 SQLite 连接，不能跨 fork 共享：每个进程第一次用到时再编译
+_CHAT_GRAPH = None
 
+def get_graph():
+    """返回当前进程编译好的 LangGraph（只编译一次）。"""
+    global _CHAT_GRAPH
+    if _CHAT_GRAPH is None:
+        _CHAT_GRAPH = graph.compile(cache=SqliteCache(path=NODE_CACHE_DB))
+    return _CHAT_GRAPH
 
-# ================== Flask API ==================
-@app.route("/api/chat", methods=["POST"])
-def chat():
+
+# ================== Quart API ==================
+async def warmup() -> None:
     """
-    POST /api/chat
-    请求: {"prompt": "..."}
-    返回: {"reply": "...", "tool_used": bool, "generated_command": "...", "missing_fields": [...]}
+    发一个极小的 prediction 预热：打开 keep-alive 连接、填充 version 缓存、唤醒模型容器。
+    直接调用 stream_replicate_model，绕过 LLM_CACHE，避免把 warmup 结果写进缓存。
     """
-    q = request.json["prompt"]
-    out = CHAT_GRAPH.invoke({"user_input": q})
-
-    cmd = out.get("command", {})
+    try:
+        async for _ in stream_replicate_model(PLAN_PROMPT, "warmup", 1, 0.0):
+            pass
+    except Exception:
+        # 预热失败不影响正常服务，第一个真实请求会照常走冷启动路径
+        app.logger.warning("Replicate warmup failed", exc_info=True)
+
+@app.before_serving
+async def _startup() -> None:
+    """worker 进程开始服务前（fork 之后）：重建 httpx 连接池，编译图，加载 embedding 模型，并在后台预热。"""
+    global _HTTPX_CLIENT
+    # 从 master 继承来的 client 属于另一个事件循环，直接丢弃，不在这里 aclose
+    _HTTPX_CLIENT = _new_client()
+    get_graph()
+    # 语义缓存的 embedding 模型在启动时加载，不让第一个请求承担几秒的加载时间
+    await asyncio.to_thread(LLM_CACHE.load)
+    if WARMUP and TOKEN:
+        # 后台执行，不阻塞 worker 开始接收请求
+        app.add_background_task(warmup)
+
+@app.after_serving
+async def _shutdown() -> None:
+    """进程退出前关闭连接池。"""
+    if _HTTPX_CLIENT is not None:
+        await _HTTPX_CLIENT.aclose()
+
+def json_response(payload: Dict[str, Any], status: int = 200) -> Response:
+    """用 orjson 序列化（非 ASCII 字符直接输出 UTF-8），替代 jsonify。"""
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+def _tool_fields(state: Dict[str, Any]) -> Dict[str, Any]:
+    """从 plan 结果中取出返回给前端的工具字段。"""
+    cmd = state.get("command") or {}
     # 更准确的 tool_used：只要生成了命令或提出了缺字段，都算“调用工具并有结果”
     tool_used = bool(cmd.get("generated_command")) or bool(cmd.get("missing_fields"))
-
-    return jsonify({
-        "reply": out.get("reply", ""),
+    return {
         "tool_used": tool_used,
         "generated_command": cmd.get("generated_command", ""),
         "missing_fields": cmd.get("missing_fields", []),
-    })
+    }
 
+def _sse(event: str, data: Any) -> bytes:
+    """编码一条 SSE 事件；data 用 JSON 编码，token 里的换行不会破坏事件格式。"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
 
-@app.route("/", methods=["GET"])
-def home():
+async def _chat_events(q: str) -> AsyncIterator[bytes]:
     """
-    一个最小网页 Demo：直接调用 /api/chat
-    说明：这里只是展示，不存储历史对话（每次请求独立）。
+    SSE 事件流：
+    - meta：plan 完成后立即发送 tool_used / generated_command / missing_fields
+    - token：answer 生成的文本片段（answer 命中节点缓存时整段发送一次）
+    - done / error：结束
     """
-    return """
-<!doctype html>
-<meta charset="utf-8" />
-<title>OCI IDA Demo</title>
-<style>
-  body { font-family: Arial, sans-serif; max-width: 900px; margin: 24px auto; padding: 0 14px; }
-  h2 { margin: 0 0 12px; }
-  .row { display: flex; gap: 10px; align-items: center; margin: 10px 0; flex-wrap: wrap; }
-  textarea { width: 100%; height: 92px; padding: 10px; font-size: 14px; }
-  button { padding: 8px 14px; font-size: 14px; cursor: pointer; }
-  .badge { display: inline-block; padding: 2px 10px; border-radius: 999px; background: #eee; font-size: 12px; }
-  pre { background: #f6f6f6; padding: 12px; border-radius: 8px; white-space: pre-wrap; word-break: break-word; }
-  .muted { color: #666; font-size: 12px; }
-</style>
-
-<h2>OCI IDA Demo</h2>
-<div class="muted">调用接口：POST /api/chat</div>
-
-<textarea id="q" placeholder="Ask something... (e.g., List all Object Storage buckets in my compartment using OCI CLI)"></textarea>
-
-<div class="row">
-  <button id="askBtn" onclick="ask()">Ask</button>
-  <span id="status" class="badge">idle</span>
-</div>
-
-<div id="out"></div>
-
-<script>
-async function ask() {
-  const btn = document.getElementById("askBtn");
-  const status = document.getElementById("status");
-  const out = document.getElementById("out");
-  const q = document.getElementById("q").value.trim();
-  if (!q) return;
-
-  btn.disabled = true;
-  status.textContent = "loading...";
-  out.innerHTML = "";
-
-  try {
-    const resp = await fetch("/api/chat", {
-      method: "POST",
-      headers: {"Content-Type": "application/json"},
-      body: JSON.stringify({prompt: q})
-    });
-
-    if (!resp.ok) {
-      const t = await resp.text();
-      throw new Error("HTTP " + resp.status + ": " + t);
-    }
+    streamed = False
+    try:
+        async for mode, chunk in get_graph().astream({"user_input": q}, stream_mode=["updates", "custom"]):
+            if mode == "custom":
+                streamed = True
+                yield _sse("token", chunk)
+            elif "plan" in chunk:
+                yield _sse("meta", _tool_fields(chunk["plan"]))
+            elif "answer" in chunk and not streamed:
+                yield _sse("token", chunk["answer"].get("reply", ""))
+        yield _sse("done", {})
+    except Exception as e:
+        # 响应头已经发出，只能通过事件把错误告诉前端
+        app.logger.exception("chat stream failed")
+        yield _sse("error", {"error": str(e)})
 
-    const j = await resp.json();
-    status.textContent = "done";
-
-    out.innerHTML =
-      `<p><span class="badge">tool_used: ${j.tool_used}</span></p>` +
-      (j.generated_command ? `<h4>OCI CLI Command</h4><pre>${escapeHtml(j.generated_command)}</pre>` : "") +
-      (j.missing_fields && j.missing_fields.length ? `<h4>Missing Info</h4><pre>${escapeHtml(j.missing_fields.join(", "))}</pre>` : "") +
-      `<h4>Reply</h4><pre>${escapeHtml(j.reply || "")}</pre>`;
-
-  } catch (e) {
-    status.textContent = "error";
-    out.innerHTML = `<h4>Error</h4><pre>${escapeHtml(String(e))}</pre>`;
-  } finally {
-    btn.disabled = false;
-  }
-}
-
-function escapeHtml(s) {
-  return s.replace(/[&<>"']/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c]));
-}
-
-// Ctrl+Enter 发送
-document.getElementById("q").addEventListener("keydown", (e) => {
-  if ((e.ctrlKey || e.metaKey) && e.key === "Enter") ask();
-});
-</script>
-"""
+@app.route("/api/chat", methods=["POST"])
+async def chat():
+    """
+    POST /api/chat
+    请求: {"prompt": "..."}
+    返回: {"reply": "...", "tool_used": bool, "generated_command": "...", "missing_fields": [...]}
+    请求头带 Accept: text/event-stream 时改为 SSE 流式返回（见 _chat_events）。
+    """
+    data = await request.get_json(silent=True) or {}
+    q = str(data.get("prompt") or "").strip()
+    if not q:
+        return json_response({"error": "prompt is required"}, 400)
+
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        resp = Response(_chat_events(q), content_type="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            # 关闭 nginx 代理缓冲，token 才能实时到达浏览器
+            "X-Accel-Buffering": "no",
+        })
+        # 生成可能超过 Quart 默认的 60s 响应超时
+        resp.timeout = None
+        return resp
+
+    out = await get_graph().ainvoke({"user_input": q})
+    return json_response({"reply": out.get("reply", ""), **_tool_fields(out)})
+
+
+# 一个最小网页 Demo（static/index.html）：直接调用 /api/chat
+# 生产环境建议由 nginx 直接返回该文件（见 README），Python 进程只处理 /api/chat；
+# 这里的 "/" 路由只是本地开发时的兜底。
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+with open(os.path.join(STATIC_DIR, "index.html"), "rb") as f:
+    HOME_HTML_BYTES = f.read()
+# 启动时 gzip 一次，每次请求直接写出预先算好的 bytes
+HOME_HTML_GZ = gzip.compress(HOME_HTML_BYTES, 9)
+
+
+@app.route("/", methods=["GET"])
+async def home():
+    """返回预先编码好的 Demo 页面（客户端支持时返回 gzip 版本）。"""
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        return Response(HOME_HTML_GZ, headers={
+            "Content-Type": "text/html; charset=utf-8",
+            "Content-Encoding": "gzip",
+            "Vary": "Accept-Encoding",
+        })
+    return Response(HOME_HTML_BYTES, headers={
+        "Content-Type": "text/html; charset=utf-8",
+        "Vary": "Accept-Encoding",
+    })
 
 
 if __name__ == "__main__":
-    # debug=True 仅用于本地开发演示；
-    app.run(debug=True, port=5000)
+    # 仅用于本地开发演示（单进程）；
+    # 生产环境使用 ASGI server，例如：hypercorn demo:app --workers 4 --bind 0.0.0.0:5000
+    app.run(port=5000)